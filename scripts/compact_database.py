@@ -0,0 +1,32 @@
+import argparse
+import logging
+from pathlib import Path
+
+import ysp_bot
+import ysp_bot.util
+
+
+config = ysp_bot.util.load_config()
+data_dir = Path(config['local']['data']).expanduser()
+
+parser = argparse.ArgumentParser(
+    description='Move superseded rows of the status history into an '
+                'archive database. Run this offline (eg. from cron while '
+                'the server is quiet); the server only reads the latest '
+                'status of each segment.'
+)
+parser.add_argument('--db', type=Path, default=data_dir / 'proofreading.db')
+parser.add_argument('--archive', type=Path, default=None,
+                    help='archive database (default: <db>.archive.db)')
+parser.add_argument('--vacuum', action='store_true',
+                    help='reclaim disk space after compaction')
+args = parser.parse_args()
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s %(levelname)s %(message)s')
+db = ysp_bot.ProofreadingDatabaseConnector(args.db)
+n_archived = db.compact_status_history(args.archive)
+logging.info(f'Archived {n_archived} superseded status rows')
+if args.vacuum:
+    db.cur.execute('VACUUM;')
+db.close()
@@ -0,0 +1,241 @@
+import argparse
+import json
+import logging
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+import numpy as np
+from collections import defaultdict
+from pathlib import Path
+
+from ysp_bot.backends import FakeBackend, set_backend
+from ysp_bot.dispatcher import TaskDispatcher
+from ysp_bot.rules import rules_config
+
+
+class InstrumentedLock:
+    """Drop-in replacement for `threading.Lock` that records how often
+    and how long threads wait to acquire it."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.n_acquired = 0
+        self.n_contended = 0
+        self.wait_times = []
+        self.hold_times = []
+        self._acquired_at = None
+
+    def acquire(self, blocking: bool = True, timeout: float = -1) -> bool:
+        start = time.perf_counter()
+        acquired = self._lock.acquire(blocking=False)
+        contended = not acquired
+        if not acquired and blocking:
+            acquired = self._lock.acquire(timeout=timeout)
+        if acquired:
+            now = time.perf_counter()
+            self._acquired_at = now
+            with self._stats_lock:
+                self.n_acquired += 1
+                self.n_contended += contended
+                self.wait_times.append(now - start)
+        return acquired
+
+    def release(self) -> None:
+        held = time.perf_counter() - self._acquired_at
+        self._lock.release()
+        with self._stats_lock:
+            self.hold_times.append(held)
+
+    def locked(self) -> bool:
+        return self._lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class LoadTestStats:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.db_locked_errors = 0
+        self.empty_gets = 0
+        self.in_flight = {}    # segid -> user currently working on it
+        self.duplicate_assignments = 0
+        self.assigned = defaultdict(set)    # segid -> users it was given to
+
+    def record(self, op: str, latency: float) -> None:
+        with self._lock:
+            self.latencies[op].append(latency)
+
+    def record_error(self, op: str, error: Exception) -> None:
+        with self._lock:
+            self.errors[op] += 1
+            if (isinstance(error, sqlite3.OperationalError) and
+                    'locked' in str(error)):
+                self.db_locked_errors += 1
+
+    def record_empty(self) -> None:
+        with self._lock:
+            self.empty_gets += 1
+
+    def assign(self, segid: int, user: str) -> None:
+        with self._lock:
+            holder = self.in_flight.get(segid)
+            if holder is not None and holder != user:
+                self.duplicate_assignments += 1
+            self.in_flight[segid] = user
+            self.assigned[segid].add(user)
+
+    def resolve(self, segid: int, user: str) -> None:
+        with self._lock:
+            if self.in_flight.get(segid) == user:
+                del self.in_flight[segid]
+
+
+def simulate_user(user: str, dispatcher: TaskDispatcher, stats: LoadTestStats,
+                  tables: list, deadline: float, think_time: float,
+                  action_weights: dict, seed: int) -> None:
+    rng = random.Random(seed)
+    actions, weights = zip(*action_weights.items())
+    while time.perf_counter() < deadline:
+        table = rng.choice(tables)
+        start = time.perf_counter()
+        try:
+            feed = dispatcher.sample_one_segment(table, user)
+        except Exception as e:
+            stats.record_error('get', e)
+            continue
+        stats.record('get', time.perf_counter() - start)
+        if feed is None:
+            stats.record_empty()
+            time.sleep(think_time)
+            continue
+        segid = feed['segid']
+        stats.assign(segid, user)
+        time.sleep(rng.expovariate(1 / think_time) if think_time > 0 else 0)
+
+        action = rng.choices(actions, weights)[0]
+        if action == 'abandon':
+            stats.resolve(segid, user)
+            continue
+        start = time.perf_counter()
+        try:
+            db = dispatcher.get_database()
+            if action == 'skip':
+                db.add_to_user_skiplist(user, segid)
+            else:
+                db.set_status(segid, action, user)
+            db.close()
+        except Exception as e:
+            stats.record_error(action, e)
+            continue
+        finally:
+            stats.resolve(segid, user)
+        stats.record(action, time.perf_counter() - start)
+
+
+def summarize(stats: LoadTestStats, lock: InstrumentedLock,
+              elapsed: float) -> dict:
+    def percentiles(values):
+        if not values:
+            return None
+        p50, p90, p99 = np.percentile(np.array(values) * 1000, [50, 90, 99])
+        return {'n': len(values), 'p50_ms': p50, 'p90_ms': p90,
+                'p99_ms': p99, 'max_ms': max(values) * 1000}
+
+    n_ops = sum(len(v) for v in stats.latencies.values())
+    return {
+        'elapsed_s': elapsed,
+        'throughput_ops_per_s': n_ops / elapsed,
+        'throughput_gets_per_s': len(stats.latencies['get']) / elapsed,
+        'latency': {op: percentiles(v) for op, v in stats.latencies.items()},
+        'errors': dict(stats.errors),
+        'db_locked_errors': stats.db_locked_errors,
+        'empty_gets': stats.empty_gets,
+        'duplicate_assignments': stats.duplicate_assignments,
+        'segids_given_to_multiple_users': sum(
+            len(users) > 1 for users in stats.assigned.values()
+        ),
+        'lock': {
+            'n_acquired': lock.n_acquired,
+            'n_contended': lock.n_contended,
+            'contention_ratio': lock.n_contended / max(lock.n_acquired, 1),
+            'wait': percentiles(lock.wait_times),
+            'hold': percentiles(lock.hold_times),
+        },
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Simulate concurrent proofreaders issuing get, fix, '
+                    'skip and noaction requests against the dispatcher, '
+                    'using the offline fake backend.'
+    )
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--duration', type=float, default=30,
+                        help='duration of the test in seconds')
+    parser.add_argument('--think-time', type=float, default=0.05,
+                        help='mean time a user spends on a task in seconds')
+    parser.add_argument('--table', action='append', default=None,
+                        help='table to request from (repeatable; default: '
+                             'a mix of plain /get and every table)')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='mean latency of the fake services in seconds')
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    parser.add_argument('--expiry-rate', type=float, default=0.05)
+    parser.add_argument('--n-segments', type=int, default=100_000)
+    parser.add_argument('--data-dir', type=Path, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=Path, default=None,
+                        help='write the report as JSON to this file')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    if args.data_dir is None:
+        args.data_dir = Path(tempfile.mkdtemp(prefix='ysp_bot_load_test_'))
+    args.data_dir.mkdir(parents=True, exist_ok=True)
+
+    set_backend(FakeBackend(latency=args.latency,
+                            failure_rate=args.failure_rate,
+                            expiry_rate=args.expiry_rate,
+                            n_segments=args.n_segments, seed=args.seed))
+    dispatcher = TaskDispatcher(rules_config, args.data_dir)
+    dispatcher.update_version()
+    lock = InstrumentedLock()
+    dispatcher.main_mutex = lock
+    print(f'Loaded pool: '
+          f'{ {k: len(v) for k, v in dispatcher.curr_pool.items()} }')
+
+    tables = args.table or [None] + list(dispatcher.rule_objs.keys())
+    action_weights = {'fixed': 0.3, 'noaction': 0.2, 'skip': 0.3,
+                      'abandon': 0.2}
+    stats = LoadTestStats()
+    deadline = time.perf_counter() + args.duration
+    threads = [
+        threading.Thread(target=simulate_user,
+                         args=(f'user{i}', dispatcher, stats, tables,
+                               deadline, args.think_time, action_weights,
+                               args.seed + i))
+        for i in range(args.users)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    report = summarize(stats, lock, time.perf_counter() - start)
+
+    print(json.dumps(report, indent=2, default=float))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, default=float)
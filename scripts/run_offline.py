@@ -0,0 +1,71 @@
+import argparse
+import logging
+import random
+import tempfile
+import time
+from pathlib import Path
+
+from ysp_bot.backends import FakeBackend, set_backend
+from ysp_bot.dispatcher import TaskDispatcher
+from ysp_bot.rules import rules_config
+
+
+parser = argparse.ArgumentParser(
+    description='Run the refresh and serving loop against the in-process '
+                'fake backend, without any network access.'
+)
+parser.add_argument('--data-dir', type=Path, default=None,
+                    help='where to store dumps and the database '
+                         '(default: a temporary directory)')
+parser.add_argument('--refreshes', type=int, default=2,
+                    help='number of dumps to publish and load')
+parser.add_argument('--requests', type=int, default=100,
+                    help='number of tasks to request per dump')
+parser.add_argument('--latency', type=float, default=0.0)
+parser.add_argument('--failure-rate', type=float, default=0.0)
+parser.add_argument('--expiry-rate', type=float, default=0.05)
+parser.add_argument('--n-segments', type=int, default=100_000)
+parser.add_argument('--seed', type=int, default=None)
+args = parser.parse_args()
+
+logging.basicConfig(level=logging.WARNING,
+                    format='%(asctime)s %(levelname)s %(message)s')
+if args.data_dir is None:
+    args.data_dir = Path(tempfile.mkdtemp(prefix='ysp_bot_offline_'))
+args.data_dir.mkdir(parents=True, exist_ok=True)
+print(f'Using data directory {args.data_dir}')
+
+backend = FakeBackend(latency=args.latency, failure_rate=args.failure_rate,
+                      expiry_rate=args.expiry_rate,
+                      n_segments=args.n_segments, seed=args.seed)
+set_backend(backend)
+dispatcher = TaskDispatcher(rules_config, args.data_dir)
+rng = random.Random(args.seed)
+users = [f'user{i}' for i in range(10)]
+tables = [None] + list(dispatcher.rule_objs.keys())
+
+for i in range(args.refreshes):
+    if i > 0:
+        backend.publish_dump()
+    start = time.perf_counter()
+    dispatcher.update_version()
+    print(f'Refresh {i}: {time.perf_counter() - start:.2f}s, pool sizes '
+          f'{ {k: len(v) for k, v in dispatcher.curr_pool.items()} }')
+
+    start = time.perf_counter()
+    n_proposed = 0
+    for _ in range(args.requests):
+        user = rng.choice(users)
+        feed = dispatcher.sample_one_segment(rng.choice(tables), user)
+        if feed is None:
+            continue
+        n_proposed += 1
+        db = dispatcher.get_database()
+        action = rng.choice(['fixed', 'noaction', 'skip'])
+        if action == 'skip':
+            db.add_to_user_skiplist(user, feed['segid'])
+        else:
+            db.set_status(feed['segid'], action, user)
+        db.close()
+    elapsed = time.perf_counter() - start
+    print(f'Served {n_proposed}/{args.requests} requests in {elapsed:.2f}s')
@@ -1,39 +1,22 @@
 import logging
 import threading
-import gc
+import time
 import re
-import shutil
-import random
 from datetime import datetime, timedelta
 from pathlib import Path
 from slack_bolt import App
 from slack_bolt.adapter.socket_mode import SocketModeHandler
-from caveclient import CAVEclient
-from fanc.statebuilder import render_scene
 
 import ysp_bot
 import ysp_bot.util
+from ysp_bot import metrics
+from ysp_bot.backends import get_backend
+from ysp_bot.dispatcher import TaskDispatcher
 from ysp_bot.rules import rules_config
 
 
-# Useful global variables
-curr_version_timestamp = None
-curr_version_dir = None
-curr_pool = None
-main_mutex = threading.Lock()
-
-
-# Define which rules to include and what their slackbot subcommands
-get_subcommands = {subcommand: table_name
-                   for subcommand, table_name, rule_class in rules_config}
-rule_objs = {table_name: rule_class()
-             for subcommand, table_name, rule_class in rules_config}
-
-
 config = ysp_bot.util.load_config()
 credentials = ysp_bot.util.load_credentials()
-cave_client = CAVEclient(datastack_name=config['cave']['dataset'],
-                         auth_token=credentials['cave'])
 data_dir = Path(config['local']['data']).expanduser()
 data_dir.mkdir(parents=True, exist_ok=True)
 
@@ -44,6 +27,13 @@ logging.basicConfig(level=logging.INFO,
                               logging.StreamHandler()])
 
 
+# The dispatcher holds the current pool and hands out tasks. Which rules
+# are included and what their slackbot subcommands are is defined by
+# `rules_config`.
+dispatcher = TaskDispatcher(rules_config, data_dir)
+get_subcommands = dispatcher.get_subcommands
+
+
 def seconds_till_next_run(minutes_past_hour):
     """Return the number of seconds till `minutes_past_hour` minutes
     past the next whole hour."""
@@ -56,34 +46,7 @@ def seconds_till_next_run(minutes_past_hour):
 
 
 def update_version(minutes_past_hour=5):
-    global curr_version_timestamp, curr_version_dir, curr_pool, main_mutex
-    
-    logging.info('Checking for new version...')
-    ds = ysp_bot.FANCDataset.get_latest()
-    
-    if ds.mat_timestamp == curr_version_timestamp:
-        logging.warning(f'No new version found; '
-                        f'still using version {curr_version_timestamp}')
-    else:
-        curr_version_timestamp = ds.mat_timestamp
-        new_pool = {name: rule.get_table(ds)
-                    for name, rule in rule_objs.items()}
-        new_pool = {}
-        for name, rule in rule_objs.items():
-            logging.info(f'Applying prioritization rule {name}...')
-            new_pool[name] = rule.get_table(ds)
-        logging.info('Calculated new problematic tables: ' +
-                     str({k: len(v) for k, v in new_pool.items()}))
-        main_mutex.acquire()
-        curr_pool = new_pool
-        logging.info('Datset version updated')
-        main_mutex.release()
-        if curr_version_dir is not None:
-            logging.info(f'Removing old version at {curr_version_dir}')
-            shutil.rmtree(curr_version_dir)
-        curr_version_dir = ds.version_data_dir
-        del ds
-        gc.collect()  # Force garbage collection
+    dispatcher.update_version()
     
     wait_time = seconds_till_next_run(minutes_past_hour)
     threading.Timer(wait_time, update_version,
@@ -91,53 +54,6 @@ def update_version(minutes_past_hour=5):
     logging.info(f'Scheduled next version check in {wait_time} seconds')
 
 
-def sample_one_segment(table, user):
-    global curr_pool, main_mutex
-    
-    logging.info(f'Sampling one segment from {table} for {user}...')
-    
-    db = ysp_bot.ProofreadingDatabaseConnector(data_dir / 'proofreading.db')
-    
-    # If asked to sample from any table, randomly pick a table and
-    # recursively call this function
-    if table is None:
-        sample_from = list(curr_pool.keys())
-        random.shuffle(sample_from)
-        for chosen_table in sample_from:
-            result = sample_one_segment(chosen_table, user)
-            if result is not None:
-                return result
-        return None
-    
-    # First exclude rows that are definitely not valid
-    assert table in curr_pool.keys()
-    main_mutex.acquire()
-    user_skiplist = db.get_user_skiplist(user)
-    global_invalid_list = db.get_global_segids_to_skip()
-    segids_to_exclude = set.union(user_skiplist, global_invalid_list)
-    valid_sel = curr_pool[table][
-        ~curr_pool[table].index.isin(segids_to_exclude)
-    ]
-    main_mutex.release()
-    
-    # Check if this segid has been touched since the last dump
-    # Iteratively find the first row that is still valid and return it
-    valid_sel = valid_sel.sample(frac=1)    # shuffle rows first
-    for segid, etr in valid_sel.iterrows():
-        logging.debug(f'Checking {segid}...')
-        if not cave_client.chunkedgraph.is_latest_roots([segid])[0]:
-            logging.info(f'{segid} has been touched since last dump')
-            db.set_status(segid, 'expired', 'SERVER')
-            continue
-        retval = rule_objs[table].entry_to_feed(etr)
-        logging.debug(f'Found valid segid from {table}: {retval}')
-        db.close()
-        return retval
-    
-    db.close()
-    return None
-
-
 def slack_find_segid_from_button_click(client, channel_id,
                                        interactive_message_ts):
     """Super sketchy. When the user clicks a button, slack calls the
@@ -246,25 +162,27 @@ def update_home_tab(client, event, logger):
 
 
 @app.command('/get')
+@metrics.timed(metrics.request_seconds, command='get')
 def propose_segment(client, ack, respond, command, say, body):
     ack()
     args = command['text'].split()
     
-    if curr_pool is None:
+    if dispatcher.curr_pool is None:
         say(text='No pool is loaded yet. Please wait.')
         return
     say(text=(f':point_right: Your command was: `/get {command["text"]}`. '
               'I\'m working on it.'))
     
     table = get_subcommands[args[0]] if args else None
-    feed = sample_one_segment(table=table, user=body['user_id'])
+    feed = dispatcher.sample_one_segment(table=table, user=body['user_id'])
     if feed is None:
         say(text='No more segments to propose! :tada:')
         return
     
     # Get URL for rendered scene
     try:
-        scene_url = render_scene(neurons=[feed['segid']])
+        with metrics.cave_call('render_scene'):
+            scene_url = get_backend().render_scene([feed['segid']])
         segid_formated_str = (f"{feed['segid']}\n"
                               f"(<{scene_url}|Neuromancer link>)")
     except Exception as e:
@@ -272,6 +190,7 @@ def propose_segment(client, ack, respond, command, say, body):
                         f'{feed["segid"]}: {e}')
         segid_formated_str = f"{feed['segid']}"
     
+    reply_start = time.perf_counter()
     say(
         text='@You Should Proofread this neuron!',
         blocks=[
@@ -336,9 +255,11 @@ def propose_segment(client, ack, respond, command, say, body):
             }
         ]
     )
+    metrics.slack_reply_seconds.observe(time.perf_counter() - reply_start)
 
 
 @app.action('button-fixed')
+@metrics.timed(metrics.request_seconds, command='button_fixed')
 def respond_fixed_button(client, ack, body, say):
     ack()
     
@@ -355,7 +276,7 @@ def respond_fixed_button(client, ack, body, say):
     else:
         logging.info(f'User {user} marked {segid} as fixed')
         logging.debug('Connecting to database')
-        db = ysp_bot.ProofreadingDatabaseConnector(data_dir / 'proofreading.db')
+        db = dispatcher.get_database()
         db.set_status(segid, 'fixed', user)
         db.close()
         response = ':tada: You marked this neuron as fixed!'
@@ -369,6 +290,7 @@ def respond_fixed_button(client, ack, body, say):
 
 
 @app.action('button-nothing-wrong')
+@metrics.timed(metrics.request_seconds, command='button_nothing_wrong')
 def respond_noaction_button(client, ack, body, say):
     ack()
     
@@ -385,7 +307,7 @@ def respond_noaction_button(client, ack, body, say):
     else:
         logging.info(f'User {user} marked {segid} as fixed')
         logging.debug('Connecting to database')
-        db = ysp_bot.ProofreadingDatabaseConnector(data_dir / 'proofreading.db')
+        db = dispatcher.get_database()
         db.set_status(segid, 'noaction', user)
         db.close()
         response = (':ok_hand: OK, no action taken, '
@@ -399,6 +321,7 @@ def respond_noaction_button(client, ack, body, say):
 
 
 @app.action('button-skip')
+@metrics.timed(metrics.request_seconds, command='button_skip')
 def respond_skip_button(client, ack, body, say):
     ack()
     
@@ -415,7 +338,7 @@ def respond_skip_button(client, ack, body, say):
     else:
         logging.info(f'User {user} marked {segid} as fixed')
         logging.debug('Connecting to database')
-        db = ysp_bot.ProofreadingDatabaseConnector(data_dir / 'proofreading.db')
+        db = dispatcher.get_database()
         db.add_to_user_skiplist(user, segid)
         db.close()
         response = ':ok_hand: OK, I won\'t show this neuron to you again.'
@@ -428,6 +351,7 @@ def respond_skip_button(client, ack, body, say):
 
 
 @app.command('/mark')
+@metrics.timed(metrics.request_seconds, command='mark')
 def mark_segment(ack, say, command):
     ack()
     try:
@@ -445,7 +369,7 @@ def mark_segment(ack, say, command):
     logging.info(f'User {user} marked {segid} as {state}')
     
     logging.debug('Connecting to database')
-    db = ysp_bot.ProofreadingDatabaseConnector(data_dir / 'proofreading.db')
+    db = dispatcher.get_database()
     db.set_status(segid, state, user)
     db.close()
     
@@ -455,6 +379,7 @@ def mark_segment(ack, say, command):
 
 
 @app.command('/annotate')
+@metrics.timed(metrics.request_seconds, command='annotate')
 def annotate_segment(ack, say, command):
     ack()
     try:
@@ -475,7 +400,7 @@ def annotate_segment(ack, say, command):
     logging.info(f'User {user} annotated {segid} at {pt_pos} with: {message}')
     
     logging.debug('Connecting to database')
-    db = ysp_bot.ProofreadingDatabaseConnector(data_dir / 'proofreading.db')
+    db = dispatcher.get_database()
     db.set_annotation(segid, message, user, pt_pos)
     
     say(f':point_right: '
@@ -490,6 +415,10 @@ def handle_message_events(body, logger):
 
 
 if __name__ == '__main__':
+    if config.get('metrics', {}).get('port') is not None:
+        metrics.start_metrics_server(config['metrics']['port'],
+                                     config['metrics'].get('host',
+                                                           '127.0.0.1'))
     update_version()
     
     handler = SocketModeHandler(app, credentials['slack']['app_token'])
@@ -0,0 +1,37 @@
+import unittest
+import time
+
+from ysp_bot.metrics import MetricsRegistry
+
+
+class MetricsTest(unittest.TestCase):
+    def test_render(self):
+        registry = MetricsRegistry()
+        counter = registry.counter('test_total', 'A counter.', ('table',))
+        gauge = registry.gauge('test_size', 'A gauge.')
+        histogram = registry.histogram('test_seconds', 'A histogram.',
+                                       ('stage',), buckets=(0.5, 1.0))
+        counter.inc(table='a')
+        counter.inc(2, table='a')
+        gauge.set(42)
+        with histogram.time(stage='x'):
+            time.sleep(0.01)
+        histogram.observe(0.75, stage='x')
+
+        self.assertEqual(counter.get(table='a'), 3)
+        self.assertEqual(histogram.get_count(stage='x'), 2)
+        text = registry.render()
+        self.assertIn('test_total{table="a"} 3', text)
+        self.assertIn('test_size 42', text)
+        self.assertIn('test_seconds_bucket{stage="x",le="0.5"} 1', text)
+        self.assertIn('test_seconds_bucket{stage="x",le="+Inf"} 2', text)
+
+    def test_bad_labels(self):
+        registry = MetricsRegistry()
+        counter = registry.counter('test_total', 'A counter.', ('table',))
+        with self.assertRaises(ValueError):
+            counter.inc(rule='a')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,337 @@
+import abc
+import time
+import random
+import logging
+import threading
+import numpy as np
+import pandas as pd
+from typing import Dict, Iterable, Union
+from nptyping import NDArray, Shape, Int, Bool
+from datetime import datetime
+from subprocess import run
+from pathlib import Path
+
+import ysp_bot.util
+
+
+class ServiceBackend(abc.ABC):
+    """Interface to the external services used by the refresh and
+    serving paths: the BrainCircuits connectivity dump, the FANC point
+    lookup service, the CAVE chunkedgraph and Neuroglancer scene
+    rendering."""
+
+    @abc.abstractmethod
+    def get_dump_info(self) -> Dict:
+        """Return info on the latest connectivity table dump as a
+        dictionary with keys `last_materialized` (timestamp),
+        `nodes_url` and `edges_url`."""
+        pass
+
+    @abc.abstractmethod
+    def download_dump_file(self, url: str, tgt_path: Path) -> None:
+        """Download a dump file (nodes or edges parquet file) from
+        `url` to `tgt_path`."""
+        pass
+
+    @abc.abstractmethod
+    def segids_from_pts(self, pos: NDArray[Shape['NumPoints, 3'], Int],
+                        timestamp: datetime
+                        ) -> NDArray[Shape['NumPoints'], Int]:
+        """Look up the root IDs of the segments at the given positions
+        at the given time."""
+        pass
+
+    @abc.abstractmethod
+    def is_latest_roots(self, segids: Iterable[int]
+                        ) -> NDArray[Shape['NumSegments'], Bool]:
+        """Check whether each of the given root IDs is still current,
+        ie. the segment has not been edited since."""
+        pass
+
+    @abc.abstractmethod
+    def render_scene(self, segids: Iterable[int]) -> str:
+        """Return a Neuroglancer URL showing the given segments."""
+        pass
+
+
+class LiveBackend(ServiceBackend):
+    """Backend talking to the real BrainCircuits, CAVE and FANC
+    services. Clients are created on first use."""
+
+    def __init__(self) -> None:
+        self._cave_client = None
+        self._lock = threading.Lock()
+
+    @property
+    def cave_client(self):
+        with self._lock:
+            if self._cave_client is None:
+                from caveclient import CAVEclient
+                config = ysp_bot.util.load_config()
+                credentials = ysp_bot.util.load_credentials()
+                self._cave_client = CAVEclient(
+                    datastack_name=config['cave']['dataset'],
+                    auth_token=credentials['cave']
+                )
+            return self._cave_client
+
+    def get_dump_info(self) -> Dict:
+        import requests
+        config = ysp_bot.util.load_config()
+        credentials = ysp_bot.util.load_credentials()
+        base_url = config['braincircuits']['base_url']
+        res = requests.get(
+            f'{base_url}/circuit/graph/dump',
+            headers={'Authorization': f'Bearer {credentials["braincircuits"]}',
+                     'Authorization-Cave': f'Bearer {credentials["cave"]}'},
+            params={'project': 'fruitfly_fanc_cave'}
+        )
+        if res.status_code != 200:
+            raise RuntimeError(f'Failed to download connectivity table dump; '
+                               f'{res.status_code}: {res.text}')
+        return res.json()
+
+    def download_dump_file(self, url: str, tgt_path: Path) -> None:
+        run(['wget', '-nv', '-O', tgt_path, url])
+
+    def segids_from_pts(self, pos: NDArray[Shape['NumPoints, 3'], Int],
+                        timestamp: datetime
+                        ) -> NDArray[Shape['NumPoints'], Int]:
+        from fanc.lookup import segids_from_pts
+        return segids_from_pts(pos, return_roots=True, timestamp=timestamp)
+
+    def is_latest_roots(self, segids: Iterable[int]
+                        ) -> NDArray[Shape['NumSegments'], Bool]:
+        return np.asarray(
+            self.cave_client.chunkedgraph.is_latest_roots(list(segids))
+        )
+
+    def render_scene(self, segids: Iterable[int]) -> str:
+        from fanc.statebuilder import render_scene
+        return render_scene(neurons=list(segids))
+
+
+class FakeServiceError(RuntimeError):
+    pass
+
+
+def _hash_uniform(values: np.ndarray, salt: int = 0) -> np.ndarray:
+    """Deterministically map integers to floats in [0, 1) (splitmix64)."""
+    with np.errstate(over='ignore'):
+        z = values.astype(np.uint64) + np.uint64(0x9E3779B97F4A7C15 + salt)
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        z = z ^ (z >> np.uint64(31))
+    return (z >> np.uint64(11)).astype(np.float64) / float(1 << 53)
+
+
+class FakeBackend(ServiceBackend):
+    """In-process stand-in for the external services, so that the
+    refresh and serving loop can be run and profiled without network.
+
+    The volume is modelled as `n_segments` segments. A point belongs to
+    the segment indexed by a hash of the `block_size`-sized block it
+    falls into, so nearby points (eg. somas) may share a segment. Every
+    segment has a current root ID; when a segment is edited, it gets a
+    new root ID and the old one is no longer the latest.
+
+    Parameters
+    ----------
+    latency : float
+        Mean simulated latency of every service call, in seconds. The
+        actual latency is drawn uniformly from [0.5, 1.5] x `latency`.
+    failure_rate : float
+        Probability that a service call raises `FakeServiceError`.
+    expiry_rate : float
+        Probability that a root, the first time its freshness is
+        checked, turns out to have been edited since the last dump.
+    n_segments : int
+        Number of segments in the simulated volume.
+    dump_interval : float, optional
+        If set, a new dump is published every `dump_interval` seconds.
+        Otherwise, new dumps are only published by `publish_dump()`.
+    block_size : int
+        Size of the blocks (in voxels) used to map points to segments.
+    seed : int, optional
+        Random seed.
+    """
+
+    root_id_base = 648518346400000000
+
+    def __init__(self, latency: float = 0.0, failure_rate: float = 0.0,
+                 expiry_rate: float = 0.0, n_segments: int = 100_000,
+                 dump_interval: float = None, block_size: int = 256,
+                 seed: int = None) -> None:
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.expiry_rate = expiry_rate
+        self.n_segments = n_segments
+        self.dump_interval = dump_interval
+        self.block_size = block_size
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._root_of_index = (self.root_id_base +
+                               np.arange(n_segments, dtype=np.int64))
+        self._index_of_root = {}
+        self._next_root = self.root_id_base + n_segments
+        self._checked_roots = set()
+        self._dump_timestamp = None
+        self._last_publish_time = None
+        self.publish_dump()
+
+    def _simulate_call(self) -> None:
+        if self.latency > 0:
+            time.sleep(self.latency * (0.5 + self._rng.random()))
+        if self._rng.random() < self.failure_rate:
+            raise FakeServiceError('Simulated service failure')
+
+    def _index_of(self, segid: int) -> Union[int, None]:
+        offset = segid - self.root_id_base
+        if 0 <= offset < self.n_segments:
+            return offset
+        return self._index_of_root.get(segid)
+
+    def edit_segments(self, segids: Iterable[int]) -> Dict[int, int]:
+        """Simulate an edit on each of the given segments; return a
+        mapping from the old root IDs to the new ones."""
+        new_roots = {}
+        with self._lock:
+            for segid in segids:
+                idx = self._index_of(segid)
+                if idx is None or self._root_of_index[idx] != segid:
+                    continue
+                new_root = self._next_root
+                self._next_root += 1
+                self._index_of_root[new_root] = idx
+                self._root_of_index[idx] = new_root
+                new_roots[segid] = new_root
+        return new_roots
+
+    def publish_dump(self, timestamp: int = None) -> int:
+        """Publish a new dump reflecting the current state of all
+        segments; return its materialization timestamp."""
+        with self._lock:
+            if timestamp is None:
+                timestamp = int(time.time())
+                if self._dump_timestamp is not None:
+                    timestamp = max(timestamp, self._dump_timestamp + 1)
+            self._dump_timestamp = timestamp
+            self._dump_roots = self._root_of_index.copy()
+            self._last_publish_time = time.monotonic()
+            self._checked_roots.clear()
+        return timestamp
+
+    def get_dump_info(self) -> Dict:
+        self._simulate_call()
+        if (self.dump_interval is not None and
+                time.monotonic() - self._last_publish_time
+                >= self.dump_interval):
+            self.publish_dump()
+        ts = self._dump_timestamp
+        return {'last_materialized': ts,
+                'nodes_url': f'fake://nodes/{ts}',
+                'edges_url': f'fake://edges/{ts}'}
+
+    def _node_table(self, roots: np.ndarray) -> pd.DataFrame:
+        u_post = _hash_uniform(roots, salt=1)
+        u_pre = _hash_uniform(roots, salt=2)
+        nr_post = np.floor(u_post ** 3 * 3000)
+        nr_pre = np.floor(u_pre ** 3 * 3000)
+        return pd.DataFrame({
+            'segment_id': roots,
+            'size': (_hash_uniform(roots, salt=3) * 1e9).astype(np.int64),
+            'nr_pre': nr_pre,
+            'nr_downstream_partner': np.ceil(nr_pre / 2),
+            'nr_post': nr_post,
+            'nr_upstream_partner': np.ceil(nr_post / 2),
+        })
+
+    def _edge_table(self, roots: np.ndarray, timestamp: int) -> pd.DataFrame:
+        rng = np.random.default_rng(timestamp)
+        n_edges = 5 * len(roots)
+        return pd.DataFrame({
+            'src': roots[rng.integers(0, len(roots), n_edges)],
+            'dst': roots[rng.integers(0, len(roots), n_edges)],
+            'count': rng.geometric(0.3, n_edges)
+        })
+
+    def download_dump_file(self, url: str, tgt_path: Path) -> None:
+        self._simulate_call()
+        kind, timestamp = url.removeprefix('fake://').split('/')
+        if int(timestamp) != self._dump_timestamp:
+            raise FakeServiceError(f'Dump {timestamp} is no longer available')
+        roots = self._dump_roots
+        if kind == 'nodes':
+            df = self._node_table(roots)
+        elif kind == 'edges':
+            df = self._edge_table(roots, int(timestamp))
+        else:
+            raise ValueError(f'Unknown dump file `{url}`')
+        df.to_parquet(tgt_path)
+
+    def segids_from_pts(self, pos: NDArray[Shape['NumPoints, 3'], Int],
+                        timestamp: datetime
+                        ) -> NDArray[Shape['NumPoints'], Int]:
+        self._simulate_call()
+        blocks = np.asarray(pos, dtype=np.int64) // self.block_size
+        key = (blocks[:, 0] * 73856093 ^ blocks[:, 1] * 19349663 ^
+               blocks[:, 2] * 83492791)
+        idx = (_hash_uniform(key) * self.n_segments).astype(np.int64)
+        with self._lock:
+            return self._root_of_index[idx].copy()
+
+    def is_latest_roots(self, segids: Iterable[int]
+                        ) -> NDArray[Shape['NumSegments'], Bool]:
+        self._simulate_call()
+        segids = list(segids)
+        to_edit = []
+        with self._lock:
+            for segid in segids:
+                if segid in self._checked_roots:
+                    continue
+                self._checked_roots.add(segid)
+                if self._rng.random() < self.expiry_rate:
+                    to_edit.append(segid)
+        self.edit_segments(to_edit)
+        with self._lock:
+            res = []
+            for segid in segids:
+                idx = self._index_of(segid)
+                res.append(idx is not None and
+                           self._root_of_index[idx] == segid)
+        return np.array(res, dtype=bool)
+
+    def render_scene(self, segids: Iterable[int]) -> str:
+        self._simulate_call()
+        return ('https://neuroglancer.example.org/#!fake-scene-' +
+                '-'.join(str(x) for x in segids))
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend() -> ServiceBackend:
+    """Return the service backend in use, creating it from the
+    `backend` section of the config on first use."""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            backend_config = ysp_bot.util.load_config().get('backend', {})
+            backend_type = backend_config.get('type', 'live')
+            if backend_type == 'live':
+                _backend = LiveBackend()
+            elif backend_type == 'fake':
+                _backend = FakeBackend(**backend_config.get('fake', {}))
+            else:
+                raise ValueError(f'Backend type `{backend_type}` '
+                                 'not recognized.')
+            logging.info(f'Using {type(_backend).__name__}')
+        return _backend
+
+
+def set_backend(backend: ServiceBackend) -> None:
+    """Use `backend` for all subsequent service calls."""
+    global _backend
+    with _backend_lock:
+        _backend = backend
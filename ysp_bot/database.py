@@ -1,12 +1,19 @@
 import sqlite3
 import pandas as pd
-from typing import Tuple, Set
+from typing import Tuple, Set, Union
 from datetime import datetime
 from pathlib import Path
 
+from ysp_bot import metrics
+
+
+# Segments whose latest status is one of these are not proposed again
+skip_statuses = ('expired', 'fixed', 'noaction', 'done')
+
 
 class ProofreadingDatabaseConnector:
     def __init__(self, db_path: Path) -> None:
+        self.db_path = db_path
         if not db_path.is_file():
             self.con = sqlite3.connect(db_path)
             self.cur = self.con.cursor()
@@ -38,7 +45,37 @@ class ProofreadingDatabaseConnector:
             ''')
         self.con = sqlite3.connect(db_path)
         self.cur = self.con.cursor()
+        self._ensure_status_current()
+    
+    def _ensure_status_current(self) -> None:
+        """Create the `status_current` table, which holds the latest
+        row of `status` for each segid, and fill it from the full
+        history if it doesn't exist yet (eg. for databases created
+        before it was introduced)."""
+        self.cur.execute('''
+            SELECT name FROM sqlite_master
+                WHERE type = 'table' AND name = 'status_current';
+        ''')
+        if self.cur.fetchone() is not None:
+            return
+        self.cur.execute('''
+            CREATE TABLE status_current (
+                segid BIGINT PRIMARY KEY,
+                status CHAR(16),
+                user CHAR(64),
+                timestamp DATETIME
+            );
+        ''')
+        self.cur.execute('''
+            INSERT OR REPLACE INTO status_current
+                SELECT segid, status, user, timestamp FROM status
+                    WHERE rowid IN (
+                        SELECT MAX(rowid) FROM status GROUP BY segid
+                    );
+        ''')
+        self.con.commit()
     
+    @metrics.timed(metrics.db_query_seconds, query='get_user_skiplist')
     def get_user_skiplist(self, user: str) -> Set:
         # select all segids from "user_skiplist" table where user is "user"
         self.cur.execute('''
@@ -47,6 +84,7 @@ class ProofreadingDatabaseConnector:
         segids = {x[0] for x in self.cur.fetchall()}
         return segids
             
+    @metrics.timed(metrics.db_query_seconds, query='add_to_user_skiplist')
     def add_to_user_skiplist(self, user: str, segid: int) -> None:
         now = datetime.now()
         self.cur.execute('''
@@ -54,21 +92,38 @@ class ProofreadingDatabaseConnector:
         ''', (user, segid, now))
         self.con.commit()
     
+    @metrics.timed(metrics.db_query_seconds, query='get_global_segids_to_skip')
     def get_global_segids_to_skip(self) -> Set:
-        self.cur.execute('''
-            SELECT segid FROM status
-                WHERE status IN ("expired", "fixed", "noaction");
-        ''')
+        placeholders = ', '.join('?' * len(skip_statuses))
+        self.cur.execute(f'''
+            SELECT segid FROM status_current
+                WHERE status IN ({placeholders});
+        ''', skip_statuses)
         segids = {x[0] for x in self.cur.fetchall()}
         return segids
     
+    @metrics.timed(metrics.db_query_seconds, query='get_status')
+    def get_status(self, segid: int) -> Union[str, None]:
+        """Return the latest status of `segid`, or None if it has
+        never been set."""
+        self.cur.execute('''
+            SELECT status FROM status_current WHERE segid = ?;
+        ''', (segid,))
+        row = self.cur.fetchone()
+        return None if row is None else row[0]
+    
+    @metrics.timed(metrics.db_query_seconds, query='set_status')
     def set_status(self, segid: int, status: str, user: str) -> None:
         now = datetime.now()
-        self.cur.execute('''
-            INSERT INTO status VALUES (?, ?, ?, ?);
-        ''', (segid, status, user, now))
-        self.con.commit()
+        with self.con:    # both writes are committed in one transaction
+            self.cur.execute('''
+                INSERT INTO status VALUES (?, ?, ?, ?);
+            ''', (segid, status, user, now))
+            self.cur.execute('''
+                INSERT OR REPLACE INTO status_current VALUES (?, ?, ?, ?);
+            ''', (segid, status, user, now))
     
+    @metrics.timed(metrics.db_query_seconds, query='set_annotation')
     def set_annotation(self, segid: int, annotation: str, user: str,
                        pt_pos: Tuple[int, int, int]) -> None:
         now = datetime.now()
@@ -77,5 +132,50 @@ class ProofreadingDatabaseConnector:
         ''', (segid, annotation, user, now, *pt_pos))
         self.con.commit()
     
+    def compact_status_history(self, archive_path: Path = None) -> int:
+        """Move all rows of the `status` table that have been
+        superseded by a later status of the same segid into a separate
+        archive database. Return the number of rows archived.
+
+        Parameters
+        ----------
+        archive_path : Path, optional
+            SQLite file to which superseded rows are appended. Defaults
+            to the database path with the suffix `.archive.db`.
+        """
+        if archive_path is None:
+            archive_path = self.db_path.with_suffix('.archive.db')
+        self.cur.execute('ATTACH DATABASE ? AS archive;', (str(archive_path),))
+        try:
+            self.cur.execute('''
+                CREATE TABLE IF NOT EXISTS archive.status (
+                    segid BIGINT,
+                    status CHAR(16),
+                    user CHAR(64),
+                    timestamp DATETIME
+                );
+            ''')
+            with self.con:
+                self.cur.execute('''
+                    CREATE TEMP TABLE latest_rowids AS
+                        SELECT MAX(rowid) AS rowid FROM main.status
+                            GROUP BY segid;
+                ''')
+                self.cur.execute('''
+                    INSERT INTO archive.status
+                        SELECT segid, status, user, timestamp FROM main.status
+                            WHERE rowid NOT IN (SELECT rowid FROM latest_rowids)
+                            ORDER BY rowid;
+                ''')
+                self.cur.execute('''
+                    DELETE FROM main.status
+                        WHERE rowid NOT IN (SELECT rowid FROM latest_rowids);
+                ''')
+                n_archived = self.cur.rowcount
+                self.cur.execute('DROP TABLE latest_rowids;')
+        finally:
+            self.cur.execute('DETACH DATABASE archive;')
+        return n_archived
+    
     def close(self):
         self.con.close()
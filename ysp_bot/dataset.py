@@ -1,18 +1,16 @@
 import pandas as pd
 import numpy as np
 import logging
-import requests
 import json
 from typing import Union, List, Iterable, Tuple
 from nptyping import NDArray, Shape, Int
 from datetime import datetime
-from subprocess import run
 from pathlib import Path
-from fanc.lookup import segids_from_pts
-# from fanc.rootID_lookup import segIDs_from_pts_service
 
 import ysp_bot
 import ysp_bot.util
+from ysp_bot import metrics
+from ysp_bot.backends import get_backend
 
 
 config = ysp_bot.util.load_config()
@@ -27,10 +25,9 @@ def materialize_positions(pos: NDArray[Shape['NumPoints, 3'], Int],
     """Materialize a dataframe at a given timestamp."""
     if not isinstance(timestamp, datetime):
         timestamp = datetime.fromtimestamp(timestamp)
-    # rootids = segIDs_from_pts_service(pos, return_roots=True,
-    #                                   timestamp=timestamp)
-    rootids = segids_from_pts(pos, return_roots=True,
-                              timestamp=timestamp)
+    with metrics.cave_call('segids_from_pts'):
+        rootids = get_backend().segids_from_pts(pos, timestamp=timestamp)
+    metrics.materialized_points_total.inc(pos.shape[0])
     assert rootids is not None and rootids.size == pos.shape[0]
     return rootids
 
@@ -46,7 +43,8 @@ def download_bc_connectivity_dump(node_url: str,
         # if tgt_path.exists():
         #     continue
         logging.info(f'Downloading {key} dump from braincircuits...')
-        run(['wget', '-nv', '-O', tgt_path, url])
+        with metrics.refresh_stage_seconds.time(stage=f'download_{key}'):
+            get_backend().download_dump_file(url, tgt_path)
     node_table = pd.read_parquet(save_dir / 'bc_nodes.parquet')
     edge_table = pd.read_parquet(save_dir / 'bc_edges.parquet')
     node_table.set_index('segment_id', inplace=True)
@@ -59,16 +57,23 @@ def download_bc_connectivity_dump(node_url: str,
 def materialize_cave_tables(mat_timestamp: int, cave_data_dir: Path = None,
                             save_dir: Path = None
                             ) -> dict[str, pd.DataFrame]:
-    cave_data_dir = (Path(config['local']['data']).expanduser() /
-                     'dump' / f'cave_{cave_version}')
+    if cave_data_dir is None:
+        cave_data_dir = data_dir / 'dump' / f'cave_{cave_version}'
+        if not cave_data_dir.is_dir():
+            # Fall back to the copy of the reference tables shipped with
+            # the package (eg. when running offline without setup.py)
+            cave_data_dir = ysp_bot.ysp_dir / 'data' / f'cave_{cave_version}'
     cave_tables = {}
     for cave_table_name in config['cave']['tables'].values():
         df = pd.read_parquet(cave_data_dir / f'{cave_table_name}.parquet')
         df[['x', 'y', 'z']] = df['pt_position'].to_list()
         logging.info(f'Materializing {cave_table_name} from CAVE...')
-        df['remat_segment_id'] = materialize_positions(
-            df[['x', 'y', 'z']].values, mat_timestamp
-        )
+        with metrics.refresh_stage_seconds.time(
+            stage=f'materialize_{cave_table_name}'
+        ):
+            df['remat_segment_id'] = materialize_positions(
+                df[['x', 'y', 'z']].values, mat_timestamp
+            )
         cave_tables[cave_table_name] = df
     
     if save_dir is not None:
@@ -95,9 +100,12 @@ def materialize_neck_connective(mat_timestamp: int, json_file: Path = None,
         _dfs.append(df)
     df = pd.concat(_dfs)
     logging.info('Materializing neck connective table...')
-    df['remat_segment_id'] = materialize_positions(
-        df[['x', 'y', 'z']].values, mat_timestamp
-    )
+    with metrics.refresh_stage_seconds.time(
+        stage='materialize_neck_connective'
+    ):
+        df['remat_segment_id'] = materialize_positions(
+            df[['x', 'y', 'z']].values, mat_timestamp
+        )
     
     if save_dir is not None:
         save_dir.mkdir(parents=True, exist_ok=True)
@@ -153,28 +161,27 @@ class FANCDataset:
     
 
     @classmethod
-    def get_latest(cls):
+    @metrics.timed(metrics.refresh_stage_seconds, stage='get_latest')
+    def get_latest(cls, dump_dir: Path = None):
         """Download the latest connectivity table dump from
         BrainCircuits and materialize the reference version of the
-        CAVE tables to its materialization timestamp."""
-        base_url = config['braincircuits']['base_url']
-        credentials = ysp_bot.util.load_credentials()
-        res = requests.get(
-            f'{base_url}/circuit/graph/dump',
-            headers={'Authorization': f'Bearer {credentials["braincircuits"]}',
-                     'Authorization-Cave': f'Bearer {credentials["cave"]}'},
-            params={'project': 'fruitfly_fanc_cave'}
-        )
-        if res.status_code != 200:
-            raise RuntimeError(f'Failed to download connectivity table dump; '
-                               f'{res.status_code}: {res.text}')
-        links_dict = res.json()
+        CAVE tables to its materialization timestamp.
+
+        Parameters
+        ----------
+        dump_dir : Path, optional
+            Directory under which versions are stored. Defaults to
+            `dump` under the local data directory in the config.
+        """
+        if dump_dir is None:
+            dump_dir = data_dir / 'dump'
+        with metrics.cave_call('braincircuits_dump'):
+            links_dict = get_backend().get_dump_info()
         mat_timestamp = links_dict['last_materialized']
         node_url = links_dict['nodes_url']
         edge_url = links_dict['edges_url']
         
-        mat_timestamp = mat_timestamp
-        version_data_dir = data_dir / 'dump' / f'bc_dump_{mat_timestamp}'
+        version_data_dir = dump_dir / f'bc_dump_{mat_timestamp}'
         version_data_dir.mkdir(parents=True, exist_ok=True)
         
         # If everything is done, then just load the data
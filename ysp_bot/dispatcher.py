@@ -0,0 +1,148 @@
+import logging
+import threading
+import gc
+import shutil
+import random
+from typing import Dict, List, Tuple, Type, Union
+from pathlib import Path
+
+import ysp_bot
+from ysp_bot import metrics
+from ysp_bot.backends import ServiceBackend, get_backend
+from ysp_bot.dataset import FANCDataset
+
+
+class TaskDispatcher:
+    """Holds the current pool of proofreading tasks and hands them out
+    to users. The pool is rebuilt by `update_version` whenever a new
+    FANC data dump is found.
+
+    Parameters
+    ----------
+    rules_config : List[Tuple[str, str, Type]]
+        List of (slackbot_subcommand, table_name, rule_class) tuples,
+        see `ysp_bot.rules.rules_config`.
+    data_dir : Path
+        Directory under which the proofreading database and the data
+        dumps are stored.
+    backend : ServiceBackend, optional
+        Backend used to check whether segments are still up to date.
+        Defaults to the one returned by `ysp_bot.backends.get_backend`.
+    """
+
+    def __init__(self, rules_config: List[Tuple[str, str, Type]],
+                 data_dir: Path, backend: ServiceBackend = None) -> None:
+        self.get_subcommands = {subcommand: table_name
+                                for subcommand, table_name, rule_class
+                                in rules_config}
+        self.rule_objs = {table_name: rule_class()
+                          for subcommand, table_name, rule_class
+                          in rules_config}
+        self.data_dir = data_dir
+        self.db_path = data_dir / 'proofreading.db'
+        self._backend = backend
+        self.curr_version_timestamp = None
+        self.curr_version_dir = None
+        self.curr_pool = None
+        self.main_mutex = threading.Lock()
+        self.expiry_counts = {}    # table -> [n_checked, n_expired]
+
+    @property
+    def backend(self) -> ServiceBackend:
+        return self._backend if self._backend is not None else get_backend()
+
+    def get_database(self) -> ysp_bot.ProofreadingDatabaseConnector:
+        return ysp_bot.ProofreadingDatabaseConnector(self.db_path)
+
+    def update_version(self) -> bool:
+        """Check for a new data dump and, if there is one, rebuild the
+        pool from it. Return whether the pool has been updated."""
+        logging.info('Checking for new version...')
+        ds = FANCDataset.get_latest(dump_dir=self.data_dir / 'dump')
+
+        if ds.mat_timestamp == self.curr_version_timestamp:
+            logging.warning(f'No new version found; '
+                            f'still using version {self.curr_version_timestamp}')
+            return False
+
+        self.curr_version_timestamp = ds.mat_timestamp
+        new_pool = {}
+        for name, rule in self.rule_objs.items():
+            logging.info(f'Applying prioritization rule {name}...')
+            with metrics.rule_seconds.time(rule=name):
+                new_pool[name] = rule.get_table(ds)
+        logging.info('Calculated new problematic tables: ' +
+                     str({k: len(v) for k, v in new_pool.items()}))
+        self.main_mutex.acquire()
+        self.curr_pool = new_pool
+        logging.info('Datset version updated')
+        self.main_mutex.release()
+        for name, table in new_pool.items():
+            metrics.pool_size.set(len(table), table=name)
+            metrics.expired_fraction.set(0, table=name)
+        self.expiry_counts.clear()
+        if self.curr_version_dir is not None:
+            logging.info(f'Removing old version at {self.curr_version_dir}')
+            shutil.rmtree(self.curr_version_dir)
+        self.curr_version_dir = ds.version_data_dir
+        del ds
+        gc.collect()  # Force garbage collection
+        return True
+
+    def sample_one_segment(self, table: Union[str, None], user: str
+                           ) -> Union[Dict, None]:
+        """Propose one segment from `table` (or from any table if
+        `table` is None) to `user`; return its feed entry, or None if
+        there is nothing left to propose."""
+        logging.info(f'Sampling one segment from {table} for {user}...')
+
+        # If asked to sample from any table, randomly pick a table and
+        # recursively call this function
+        if table is None:
+            sample_from = list(self.curr_pool.keys())
+            random.shuffle(sample_from)
+            for chosen_table in sample_from:
+                result = self.sample_one_segment(chosen_table, user)
+                if result is not None:
+                    return result
+            return None
+
+        db = self.get_database()
+
+        # First exclude rows that are definitely not valid
+        assert table in self.curr_pool.keys()
+        self.main_mutex.acquire()
+        user_skiplist = db.get_user_skiplist(user)
+        global_invalid_list = db.get_global_segids_to_skip()
+        segids_to_exclude = set.union(user_skiplist, global_invalid_list)
+        valid_sel = self.curr_pool[table][
+            ~self.curr_pool[table].index.isin(segids_to_exclude)
+        ]
+        self.main_mutex.release()
+
+        # Check if this segid has been touched since the last dump
+        # Iteratively find the first row that is still valid and return it
+        valid_sel = valid_sel.sample(frac=1)    # shuffle rows first
+        for segid, etr in valid_sel.iterrows():
+            logging.debug(f'Checking {segid}...')
+            with metrics.cave_call('is_latest_roots'):
+                is_latest = self.backend.is_latest_roots([segid])[0]
+            counts = self.expiry_counts.setdefault(table, [0, 0])
+            counts[0] += 1
+            metrics.freshness_checks_total.inc(table=table)
+            if not is_latest:
+                logging.info(f'{segid} has been touched since last dump')
+                counts[1] += 1
+                metrics.expired_segments_total.inc(table=table)
+                metrics.expired_fraction.set(counts[1] / counts[0],
+                                             table=table)
+                db.set_status(segid, 'expired', 'SERVER')
+                continue
+            metrics.expired_fraction.set(counts[1] / counts[0], table=table)
+            retval = self.rule_objs[table].entry_to_feed(etr)
+            logging.debug(f'Found valid segid from {table}: {retval}')
+            db.close()
+            return retval
+
+        db.close()
+        return None
@@ -0,0 +1,290 @@
+import logging
+import threading
+import time
+import functools
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Tuple, Iterable, Callable
+
+
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0)
+
+
+def _escape(value: str) -> str:
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def _format_labels(labelnames: Iterable[str], labelvalues: Iterable[str],
+                   extra: Dict[str, str] = None) -> str:
+    pairs = list(zip(labelnames, labelvalues))
+    if extra:
+        pairs += list(extra.items())
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+
+class _Metric:
+    type_name = None
+
+    def __init__(self, name: str, documentation: str,
+                 labelnames: Tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'Metric `{self.name}` expects labels '
+                             f'{self.labelnames}, got {tuple(labels)}')
+        return tuple(str(labels[k]) for k in self.labelnames)
+
+    def _render_samples(self) -> Iterable[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}',
+                 f'# TYPE {self.name} {self.type_name}']
+        with self._lock:
+            lines += list(self._render_samples())
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    """Monotonically increasing count, eg. number of expired segments."""
+    type_name = 'counter'
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def _render_samples(self) -> Iterable[str]:
+        for key, value in sorted(self._values.items()):
+            yield f'{self.name}{_format_labels(self.labelnames, key)} {value}'
+
+
+class Gauge(_Metric):
+    """Value that can go up and down, eg. the size of a pool table."""
+    type_name = 'gauge'
+
+    def set(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def get(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def _render_samples(self) -> Iterable[str]:
+        for key, value in sorted(self._values.items()):
+            yield f'{self.name}{_format_labels(self.labelnames, key)} {value}'
+
+
+class Histogram(_Metric):
+    """Distribution of durations (in seconds) with cumulative buckets."""
+    type_name = 'histogram'
+
+    def __init__(self, name: str, documentation: str,
+                 labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = default_buckets) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = {'counts': [0] * len(self.buckets),
+                                     'sum': 0.0, 'count': 0}
+            entry = self._values[key]
+            for i, upper in enumerate(self.buckets):
+                if value <= upper:
+                    entry['counts'][i] += 1
+            entry['sum'] += value
+            entry['count'] += 1
+
+    def get_count(self, **labels) -> int:
+        with self._lock:
+            entry = self._values.get(self._key(labels))
+            return 0 if entry is None else entry['count']
+
+    def get_sum(self, **labels) -> float:
+        with self._lock:
+            entry = self._values.get(self._key(labels))
+            return 0.0 if entry is None else entry['sum']
+
+    @contextmanager
+    def time(self, **labels):
+        """Context manager that observes the wall time of its body."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _render_samples(self) -> Iterable[str]:
+        for key, entry in sorted(self._values.items()):
+            for upper, count in zip(self.buckets, entry['counts']):
+                labels = _format_labels(self.labelnames, key,
+                                        {'le': repr(float(upper))})
+                yield f'{self.name}_bucket{labels} {count}'
+            labels = _format_labels(self.labelnames, key, {'le': '+Inf'})
+            yield f'{self.name}_bucket{labels} {entry["count"]}'
+            labels = _format_labels(self.labelnames, key)
+            yield f'{self.name}_sum{labels} {entry["sum"]}'
+            yield f'{self.name}_count{labels} {entry["count"]}'
+
+
+class MetricsRegistry:
+    def __init__(self) -> None:
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric_cls, name, *args, **kwargs):
+        with self._lock:
+            if name in self._metrics:
+                metric = self._metrics[name]
+                if not isinstance(metric, metric_cls):
+                    raise ValueError(f'Metric `{name}` is already registered '
+                                     f'as a {metric.type_name}')
+                return metric
+            metric = metric_cls(name, *args, **kwargs)
+            self._metrics[name] = metric
+            return metric
+
+    def counter(self, name: str, documentation: str,
+                labelnames: Tuple[str, ...] = ()) -> Counter:
+        return self._register(Counter, name, documentation, labelnames)
+
+    def gauge(self, name: str, documentation: str,
+              labelnames: Tuple[str, ...] = ()) -> Gauge:
+        return self._register(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name: str, documentation: str,
+                  labelnames: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = default_buckets) -> Histogram:
+        return self._register(Histogram, name, documentation, labelnames,
+                              buckets=buckets)
+
+    def render(self) -> str:
+        """Render all metrics in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+registry = MetricsRegistry()
+
+
+# Metrics shared by the refresh and serving paths ==========
+refresh_stage_seconds = registry.histogram(
+    'ysp_refresh_stage_seconds',
+    'Time spent in each stage of a dataset refresh.', ('stage',)
+)
+materialized_points_total = registry.counter(
+    'ysp_materialized_points_total',
+    'Number of points looked up when rematerializing tables.'
+)
+rule_seconds = registry.histogram(
+    'ysp_rule_seconds', 'Time spent building each prioritization table.',
+    ('rule',)
+)
+db_query_seconds = registry.histogram(
+    'ysp_db_query_seconds', 'Time spent in each proofreading database call.',
+    ('query',)
+)
+cave_call_seconds = registry.histogram(
+    'ysp_cave_call_seconds', 'Time spent in calls to CAVE and FANC services.',
+    ('call',)
+)
+cave_call_errors_total = registry.counter(
+    'ysp_cave_call_errors_total',
+    'Number of failed calls to CAVE and FANC services.', ('call',)
+)
+request_seconds = registry.histogram(
+    'ysp_request_seconds', 'End-to-end handling time of bot commands.',
+    ('command',)
+)
+slack_reply_seconds = registry.histogram(
+    'ysp_slack_reply_seconds', 'Time spent sending replies to Slack.'
+)
+pool_size = registry.gauge(
+    'ysp_pool_size', 'Number of rows in each table of the current pool.',
+    ('table',)
+)
+freshness_checks_total = registry.counter(
+    'ysp_freshness_checks_total',
+    'Number of segments checked for freshness before being proposed.',
+    ('table',)
+)
+expired_segments_total = registry.counter(
+    'ysp_expired_segments_total',
+    'Number of proposed segments found to be outdated.', ('table',)
+)
+expired_fraction = registry.gauge(
+    'ysp_expired_fraction',
+    'Fraction of freshness checks on each table that found an expired '
+    'segment since the pool was last refreshed.', ('table',)
+)
+
+
+def timed(histogram: Histogram, **labels) -> Callable:
+    """Decorator that observes the wall time of every call to the
+    decorated function in `histogram` with the given labels."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with histogram.time(**labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def cave_call(call: str):
+    """Time a call to an external CAVE/FANC service and count it as an
+    error if it raises."""
+    try:
+        with cave_call_seconds.time(call=call):
+            yield
+    except Exception:
+        cave_call_errors_total.inc(call=call)
+        raise
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(f'Metrics endpoint: {format % args}')
+
+
+def start_metrics_server(port: int, host: str = '127.0.0.1'
+                         ) -> ThreadingHTTPServer:
+    """Serve all registered metrics in the Prometheus text format at
+    `http://host:port/metrics` from a daemon thread."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True,
+                              name='metrics-server')
+    thread.start()
+    logging.info(f'Serving metrics at http://{host}:{port}/metrics')
+    return server
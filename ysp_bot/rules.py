@@ -84,9 +84,10 @@ class OrphanedSoma(PrioritizationRule):
 class MultipleSomas(PrioritizationRule):
     def get_table(self, dataset: FANCDataset) -> pd.DataFrame:
         count = dataset.soma_table['remat_segment_id'].value_counts()
-        res = count[count > 1].to_frame().reset_index(names='segment_id')
-        res.rename(columns={'remat_segment_id': 'num_somas'}, inplace=True)
-        return res.set_index('segment_id')
+        # Name the column explicitly; pandas>=2 calls it `count`
+        res = count[count > 1].rename('num_somas').to_frame()
+        res.index.name = 'segment_id'
+        return res
     
     def entry_to_feed(self, etr: pd.Series) -> Dict:
         return {